@@ -2,21 +2,31 @@
 
 import io
 import csv
-import json
-import time
+import codecs
+import asyncio
+import itertools
 import glob
+import time
+import threading
+import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import aiohttp
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import get_encoding_from_headers
+from urllib3.util.retry import Retry
 import click
-from spatula import HtmlPage, HtmlListPage, CSS, XPath, URL
-from dataclasses import dataclass, field, asdict
-from flatten_dict import flatten
+from spatula import HtmlPage, HtmlListPage, CSS, URL
+from dataclasses import dataclass, field, fields, asdict
 from lxml import etree
+from lxml.cssselect import CSSSelector
 import traceback
 # Data Models ##############
 
 
-@dataclass
+@dataclass(slots=True)
 class Person:
     first: str
     middle: str = ""
@@ -36,7 +46,7 @@ class Person:
     party: str = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class Entity:
     folder_id: str
     entity_id: str
@@ -57,23 +67,129 @@ class Entity:
     associated_people: list[Person] = field(default_factory=list)
 
 
+# some mapped labels (e.g. county) have no Entity or Person field, so values
+# are checked against these before being set
+_ENTITY_FIELDS = frozenset(f.name for f in fields(Entity))
+_PERSON_FIELDS = frozenset(f.name for f in fields(Person))
+
+
 # scrapers ##################
 
+# the site is flaky, retry transient gateway errors with backoff
+_RETRIES = 3
+_RETRY_BACKOFF = 0.5
+_RETRY_STATUSES = (502, 503, 504)
+
+# shared so that repeated requests reuse the same keep-alive connection
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=_RETRIES,
+            backoff_factor=_RETRY_BACKOFF,
+            status_forcelist=_RETRY_STATUSES,
+        ),
+    ),
+)
+
+
+class _RateLimiter:
+    """
+    allow at most one call per `interval` seconds across all threads
+
+    time spent on the previous request counts toward the wait, so slow
+    responses don't add a full extra delay on top
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+# be polite to the registration pages
+_REGISTRATION_LIMITER = _RateLimiter(1.0)
+
+EMPTY_MSG = "There are no recorded transactions for this entity in this year."
+_EMPTY_BODY = EMPTY_MSG.encode()
+
+
+def _iter_lines(chunks, encoding):
+    # csv needs whole lines (with endings) to handle quoted newlines correctly
+    partial = ""
+    for chunk in codecs.iterdecode(chunks, encoding):
+        *lines, partial = (partial + chunk).split("\n")
+        for line in lines:
+            yield line + "\n"
+    if partial:
+        yield partial
+
 
 def _fetch_disclosures(entity_id, year):
-    EMPTY_MSG = "There are no recorded transactions for this entity in this year."
     url = f"https://disclosures.utah.gov/Search/AdvancedSearch/GenerateReport/{entity_id}?ReportYear={year}"
-    resp = requests.get(url)
-    if resp.text == EMPTY_MSG:
-        return []
-    else:
-        reader = csv.DictReader(io.StringIO(resp.text))
-        return list(reader)
+    with _SESSION.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        chunks = resp.iter_content(chunk_size=1 << 16)
+        # the empty message is the entire body, so the first chunk is enough
+        first = next(chunks, b"")
+        if first == _EMPTY_BODY:
+            return
+        lines = _iter_lines(itertools.chain([first], chunks), resp.encoding or "utf-8")
+        yield from csv.DictReader(lines)
+
+
+async def _afetch_disclosures(session, entity_id, year, validator=None):
+    """
+    `validator` is the (ETag, Last-Modified) pair seen when this report was
+    last written; if given it's sent as a conditional request
+
+    returns (rows, validator) where validator comes from this response, rows
+    is None if the server says the report hasn't changed
+    """
+    url = f"https://disclosures.utah.gov/Search/AdvancedSearch/GenerateReport/{entity_id}?ReportYear={year}"
+    headers = {}
+    if validator:
+        etag, last_modified = validator
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    for attempt in range(_RETRIES + 1):
+        async with session.get(url, headers=headers) as resp:
+            # same retry/backoff policy as _SESSION
+            if resp.status in _RETRY_STATUSES and attempt < _RETRIES:
+                await asyncio.sleep(_RETRY_BACKOFF * 2**attempt)
+                continue
+            if resp.status == 304:
+                return None, validator
+            # error pages must not be written out as (empty) reports
+            resp.raise_for_status()
+            body = await resp.read()
+            # decode the way requests (and so _fetch_disclosures) does: charset
+            # from Content-Type, else ISO-8859-1 for text/* types
+            encoding = get_encoding_from_headers(resp.headers) or "utf-8"
+            validator = (resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+            break
+    # compare the raw bytes so only real reports get decoded
+    if body == _EMPTY_BODY:
+        return [], validator
+    return list(csv.DictReader(io.StringIO(body.decode(encoding)))), validator
 
 
 def _get_report_html(report_id):
     url = f"https://disclosures.utah.gov/Reports/GetReport/{report_id}"
-    resp = requests.get(url)
+    resp = _SESSION.get(url)
     return resp.text
 
 # def _get_lobbyist_folder(folder_id):
@@ -81,6 +197,56 @@ def _get_report_html(report_id):
 #     resp = requests.get(url)
 #     return resp.text
 
+# selectors are compiled once here, rather than on every page/fieldset
+_H1 = CSSSelector("h1")
+_FIELDSETS = CSSSelector("div.fieldset,fieldset")
+# id() uses libxml2's id table instead of scanning the whole document
+_IFRAME_SRC = etree.XPath("id('registrationDialogIFrame')[self::iframe]/@src")
+
+# fieldsets with these legends describe the entity itself
+_ENTITY_LEGENDS = frozenset(
+    (
+        "Corporate Information",
+        "PAC Information",
+        "PIC Information",
+        "Party Information",
+        "Candidate Information",
+        "Independent Expenditures Information",
+        "Electioneer Information",
+        "Lobbyist Information",
+        "Business Information",
+        "Payment Information",
+        "Principals (Clients) for Which the Lobbyist Works or is Hired as an Independent Contractor",
+    )
+)
+
+
+def _has_class(el, cls):
+    return cls in (el.get("class") or "").split()
+
+
+def _scan_fieldset(fieldset):
+    """
+    walk a fieldset once, collecting its legend text and the (label, value)
+    pairs of every label inside a div.dis-cell
+    """
+    legend = None
+    labels = []
+    for el in fieldset.iter("legend", "span", "label"):
+        if el.tag == "label":
+            parent = el.getparent()
+            while parent is not None:
+                if parent.tag == "div" and _has_class(parent, "dis-cell"):
+                    labels.append((el.text_content(), el.tail))
+                    break
+                if parent is fieldset:
+                    break
+                parent = parent.getparent()
+        elif legend is None and (el.tag == "legend" or _has_class(el, "fieldset")):
+            legend = el.text_content().strip()
+    return legend or "", labels
+
+
 class LobbyistFolder(HtmlPage):
 
     def get_source_from_input(self):
@@ -90,7 +256,7 @@ class LobbyistFolder(HtmlPage):
 
     def process_page(self):
         # metadata is in this iframe
-        url = XPath("//iframe[@id='registrationDialogIFrame']/@src").match(self.root)[0]
+        url = _IFRAME_SRC(self.root)[0]
         
         return EntityMetadata(self.input, source=url)
 
@@ -115,15 +281,15 @@ class EntityList(HtmlListPage):
     selector = CSS("tbody tr")
 
     def process_item(self, item):
-        entity_link, entity_type, *rest = item.getchildren()
-        entity_link = entity_link.getchildren()[0]
+        entity_link = item[0][0]
         name = entity_link.text_content().strip()
         url = entity_link.get("href")
         entity_id = url.split("/")[-1]
         entity = dict(
             name=name,
             entity_id=entity_id,
-            entity_type=entity_type.text_content().strip(),
+            # plain <td>, so .text is enough
+            entity_type=(item[1].text or "").strip(),
         )
         return entity
 
@@ -148,8 +314,7 @@ class LobbyistList(HtmlListPage):
     selector = CSS("li")
 
     def process_item(self, item):
-        # print(item.getchildren())
-        entity_link = item.getchildren()[0]
+        entity_link = item[0]
         name = entity_link.text_content().strip()
         url = entity_link.get("href")
         folder_id = url.split("/")[-1]
@@ -177,23 +342,7 @@ class EntityFolderDetails(HtmlPage):
 
     def process_page(self):
         # metadata is in this iframe
-        url = XPath("//iframe[@id='registrationDialogIFrame']/@src").match(self.root)[0]
-        return EntityMetadata(self.input, source=url)
-
-
-class EntityPageDetails(HtmlPage):
-    """
-    connection from the folder details page to the entity metadata page
-    """
-
-    # input is an entity ID
-
-    def get_source_from_input(self):
-        return f"https://disclosures.utah.gov/Registration/EntityDetails/{self.input}"
-
-    def process_page(self):
-        # metadata is in this iframe
-        url = self.get_source_from_input()
+        url = _IFRAME_SRC(self.root)[0]
         return EntityMetadata(self.input, source=url)
 
 
@@ -263,41 +412,41 @@ class EntityMetadata(HtmlPage):
         )
         # print(etree.tostring(self.root, pretty_print=True))
         # print(self.root.cssselect('div.fieldset'))
-        h1 = CSS("h1").match_one(self.root).text_content()
-        entity.type = self.type_mapping[h1]
+        # exactly one, as spatula's match_one required
+        (h1,) = _H1(self.root)
+        entity.type = self.type_mapping[h1.text_content()]
+        mapping = self.ENTITY_DATA_MAPPING
         try:
-            for fieldset in CSS("div.fieldset,fieldset").match(self.root):
+            fieldsets = _FIELDSETS(self.root)
+            if not fieldsets:
+                raise ValueError("no fieldsets found")
+            for fieldset in fieldsets:
                 # collect all the data
                 # print(etree.tostring(fieldset, pretty_print=True))
+                legend, labels = _scan_fieldset(fieldset)
+                # like spatula's match(), a fieldset with no labels is an error
+                if not labels:
+                    raise ValueError(f"no labels in fieldset {legend!r}")
+                # entity fields go straight onto the entity, anything else is
+                # collected for a Person (keeping Person(**data) valid)
+                is_entity = legend in _ENTITY_LEGENDS
                 data = {}
-                for item in CSS("div.dis-cell label").match(fieldset):
-                    if item.text_content() not in self.ENTITY_DATA_MAPPING:
-                        print(f'new field: {field}')
-                    else:
-                        field = self.ENTITY_DATA_MAPPING[item.text_content()]
-                        data[field] = item.tail.strip()
+                for label, value in labels:
+                    label = label.strip()
+                    field = mapping.get(label)
+                    if field is None:
+                        print(f"new field: {label}")
+                    elif is_entity:
+                        if field in _ENTITY_FIELDS:
+                            setattr(entity, field, value.strip())
+                    elif field in _PERSON_FIELDS:
+                        data[field] = value.strip()
+                if is_entity:
+                    continue
 
                 # attach it to the object
                 try:
-                    # legend = CSS("span.legend").match_one(fieldset).text_content().strip()
-                    # print(fieldset.cssselect('span.fieldset,sp'))
-                    legend = fieldset.cssselect('legend,span.fieldset')[0].text_content().strip()
-                    if legend in (
-                        "Corporate Information",
-                        "PAC Information",
-                        "PIC Information",
-                        "Party Information",
-                        "Candidate Information",
-                        "Independent Expenditures Information",
-                        "Electioneer Information",
-                        "Lobbyist Information",
-                        "Business Information",
-                        "Payment Information",
-                        "Principals (Clients) for Which the Lobbyist Works or is Hired as an Independent Contractor"
-                    ):
-                        for k, v in data.items():
-                            setattr(entity, k, v)
-                    elif legend.startswith("Information about") or legend.startswith(
+                    if legend.startswith("Information about") or legend.startswith(
                         "Personal Campaign Committee"
                     ):
                         person = Person(**data)
@@ -314,6 +463,20 @@ class EntityMetadata(HtmlPage):
             
 
 
+class EntityPageDetails(EntityMetadata):
+    """
+    entity metadata page looked up directly by entity ID
+
+    this is the same page EntityMetadata parses, so it's handled here rather
+    than fetching and parsing it a second time
+    """
+
+    # input is an entity ID
+
+    def get_source_from_input(self):
+        return f"https://disclosures.utah.gov/Registration/EntityDetails/{self.input}"
+
+
 # CLI #######################
 
 
@@ -330,13 +493,13 @@ def get_entities():
     filename = f"data/ut_entities.csv"
     seen = set()
     with open(filename, "w") as f:
-        writer = csv.DictWriter(f, ("entity_id", "entity_type", "name"))
-        writer.writeheader()
+        writer = csv.writer(f)
+        writer.writerow(("entity_id", "entity_type", "name"))
         for item in EntityList().do_scrape():
             if item["entity_id"] in seen:
                 break
             seen.add(item["entity_id"])
-            writer.writerow(item)
+            writer.writerow((item["entity_id"], item["entity_type"], item["name"]))
     print(f"wrote {len(seen)} to {filename}")
 
 
@@ -348,13 +511,13 @@ def get_lobbyists():
     filename = f"data/ut_lobbyists.csv"
     seen = set()
     with open(filename, "w") as f:
-        writer = csv.DictWriter(f, ("folder_id", "entity_type", "name"))
-        writer.writeheader()
+        writer = csv.writer(f)
+        writer.writerow(("folder_id", "entity_type", "name"))
         for item in LobbyistList().do_scrape():
             if item["folder_id"] in seen:
                 break
             seen.add(item["folder_id"])
-            writer.writerow(item)
+            writer.writerow((item["folder_id"], item["entity_type"], item["name"]))
     print(f"wrote {len(seen)} to {filename}")
 
 
@@ -399,11 +562,11 @@ def _write_registration_json(entity_id, skip_if_exists=False):
     if skip_if_exists and Path(filename).exists():
         print(f"{filename} already exists")
     else:
+        _REGISTRATION_LIMITER.wait()
         item = list(EntityPageDetails(entity_id).do_scrape())
-        with open(filename, "w") as f:
-            json.dump(asdict(item[0]), f)
+        with open(filename, "wb") as f:
+            f.write(orjson.dumps(asdict(item[0])))
         print(f"wrote {filename}")
-        time.sleep(1)
 
 
 @cli.command()
@@ -425,13 +588,19 @@ def get_all_registrations():
     Writes a single JSON file per entity.
     """
     with open("data/ut_entities.csv") as f:
-        for row in csv.DictReader(f):
-            print(row)
+        entity_ids = [row["entity_id"] for row in csv.DictReader(f)]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        futures = {
+            executor.submit(
+                _write_registration_json, entity_id, skip_if_exists=True
+            ): entity_id
+            for entity_id in entity_ids
+        }
+        for future in as_completed(futures):
             try:
-                _write_registration_json(row["entity_id"], skip_if_exists=True)
+                future.result()
             except Exception as e:
-                print(f"failed on {row['entity_id']} - {e}")
-
+                print(f"failed on {futures[future]} - {e}")
 
 
 @cli.command()
@@ -444,7 +613,15 @@ def get_disclosures(entity_id, year):
     Writes a single CSV per year, using the same fieldnames disclosures.utah.gov does.
     """
     click.echo((entity_id, year))
-    filename = f"data/ut_disclosures_{entity_id}_{year}.csv"
+    _write_disclosures(entity_id, year, _fetch_disclosures(entity_id, year))
+
+
+def _disclosures_filename(entity_id, year):
+    return f"data/ut_disclosures_{entity_id}_{year}.csv"
+
+
+def _write_disclosures(entity_id, year, rows):
+    filename = _disclosures_filename(entity_id, year)
     fieldnames = (
         "PCC",
         "CORP",
@@ -465,37 +642,108 @@ def get_disclosures(entity_id, year):
         "ZIP",
         "INKIND_COMMENTS",
     )
+    # rows may be streaming from the network, so write alongside and only
+    # replace the existing file once they've all been read; the dot prefix
+    # keeps it out of consolidate_files' glob
+    tmp_filename = os.path.join(
+        os.path.dirname(filename), "." + os.path.basename(filename)
+    )
     n = 0
-    with open(filename, "w") as f:
-        writer = csv.DictWriter(f, fieldnames)
-        writer.writeheader()
-        for row in _fetch_disclosures(entity_id, year):
-            n += 1
-            writer.writerow({k: row.get(k) for k in fieldnames})
+    try:
+        with open(tmp_filename, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(fieldnames)
+            for row in rows:
+                n += 1
+                writer.writerow([row.get(k) for k in fieldnames])
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        Path(tmp_filename).unlink(missing_ok=True)
+        raise
     print(f"wrote {n} to {filename}")
 
 
 @cli.command()
 @click.argument("start_year", type=int)
 @click.argument("end_year", type=int)
-@click.pass_context
-def get_all_disclosures(ctx, start_year: int, end_year:int=2022):
+def get_all_disclosures(start_year: int, end_year:int=2022):
     """
     Get all disclosures by entity_id.
 
     Writes a single CSV per year, using the same fieldnames disclosures.utah.gov does.
     """
-    with open("data/ut_entities.csv") as f:
-        for row in csv.DictReader(f):
-            print(row)
+    asyncio.run(_aget_all_disclosures(start_year, end_year))
+
+
+VALIDATORS_FILE = "data/ut_http_validators.json"
+
+
+def _load_validators():
+    try:
+        with open(VALIDATORS_FILE, "rb") as f:
+            validators = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+    # a 304 is only useful if we still have the file it refers to
+    return {k: v for k, v in validators.items() if Path(k).exists()}
+
+
+def _save_validators(validators):
+    # write alongside and swap in, so an interrupted save can't corrupt it
+    tmp_filename = VALIDATORS_FILE + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(orjson.dumps(validators))
+    os.replace(tmp_filename, VALIDATORS_FILE)
+
+
+async def _aget_all_disclosures(start_year, end_year):
+    semaphore = asyncio.Semaphore(16)
+    validators = _load_validators()
+
+    async def fetch(session, entity_id, year):
+        async with semaphore:
+            print(f"getting disclosures for {entity_id} in {year}")
+            filename = _disclosures_filename(entity_id, year)
             try:
-                for year in range(start_year, end_year+ 1):
-                    print(f'getting disclosures for {row["entity_id"]} in {year}')
-                    # get_disclosures(str(row["entity_id"]), str(year))
-                    ctx.invoke(get_disclosures, entity_id=row["entity_id"], year=year)
+                rows, validator = await _afetch_disclosures(
+                    session, entity_id, year, validators.get(filename)
+                )
             except Exception as e:
-                print(f"{e} failed on {row['entity_id']}")
-   
+                print(f"{e} failed on {entity_id}")
+                rows = validator = None
+            return entity_id, year, rows, validator
+
+    with open("data/ut_entities.csv") as f:
+        entity_ids = [row["entity_id"] for row in csv.DictReader(f)]
+    # entries are only recorded after their file is written, so saving
+    # whatever was collected is safe even if the run is interrupted
+    try:
+        connector = aiohttp.TCPConnector(limit_per_host=8)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = [
+                fetch(session, entity_id, year)
+                for entity_id in entity_ids
+                for year in range(start_year, end_year + 1)
+            ]
+            for task in asyncio.as_completed(tasks):
+                entity_id, year, rows, validator = await task
+                if rows is None:
+                    continue
+                try:
+                    _write_disclosures(entity_id, year, rows)
+                except Exception as e:
+                    print(f"{e} failed on {entity_id} {year}")
+                    continue
+                # only recorded once the file is written, so a validator can't
+                # point at a stale file
+                filename = _disclosures_filename(entity_id, year)
+                if any(validator):
+                    validators[filename] = validator
+                else:
+                    validators.pop(filename, None)
+    finally:
+        _save_validators(validators)
+
 
 @cli.command()
 def consolidate_files():
@@ -524,16 +772,21 @@ def consolidate_files():
         "INKIND_COMMENTS"
     )
 
-    with open("data/ut_disclosures.csv", "w") as f:
-        writer = csv.DictWriter(f, disclosure_fields)
-        writer.writeheader()
+    buffering = 1 << 20
+    with open("data/ut_disclosures.csv", "w", buffering=buffering, newline="") as out:
+        writer = csv.writer(out)
+        writer.writerow(disclosure_fields)
         for file in glob.glob('data/ut_disclosures_*'):
             print(file)
-            with open(file) as f:
-                reader = csv.DictReader(f)
+            entity_id = os.path.basename(file).split('_')[2]
+            with open(file, buffering=buffering, newline="") as f:
+                reader = csv.reader(f)
+                header = next(reader, [])
+                # position of each output field in this file, -1 if missing
+                idx = [header.index(k) if k in header else -1 for k in disclosure_fields[1:]]
                 for row in reader:
                     writer.writerow(
-                        {**{k: row.get(k) for k in disclosure_fields},**{"ENTITY_ID": file.split('_')[2]}}
+                        [entity_id] + [row[i] if 0 <= i < len(row) else "" for i in idx]
                     )
     
 
@@ -557,23 +810,6 @@ def consolidate_files():
         'aka'
     )
 
-    fields = set()
-    people = []
-    with open("data/ut_registrations.csv", "w") as f:
-        writer = csv.DictWriter(f, registration_fields)
-        writer.writeheader()
-        for file in glob.glob('data/ut_registration_*'):
-            print(file)
-            with open(file) as f:
-                obj = json.load(f)
-                for person in obj['associated_people']:
-                    person['entity_id'] = obj['entity_id']
-                    people.append(person)
-                fields.update(flatten(obj, reducer='underscore').keys())
-                writer.writerow(
-                    {k: obj.get(k) for k in registration_fields}
-                )
-
     person_fields = (
         'entity_id',
         'party',
@@ -594,15 +830,24 @@ def consolidate_files():
         
     )
 
-    # fields = set()
-
-    with open("data/ut_people.csv", "w") as f:
-        writer = csv.DictWriter(f, person_fields)
-        writer.writeheader()
-        for person in people:
-            writer.writerow({k: person.get(k) for k in person_fields})
+    # people are written alongside their registration, so nothing accumulates
+    with open("data/ut_registrations.csv", "w", newline="") as reg_out, open(
+        "data/ut_people.csv", "w", newline=""
+    ) as people_out:
+        reg_writer = csv.writer(reg_out)
+        reg_writer.writerow(registration_fields)
+        people_writer = csv.writer(people_out)
+        people_writer.writerow(person_fields)
+        for file in glob.glob('data/ut_registration_*'):
+            print(file)
+            with open(file, "rb") as f:
+                obj = orjson.loads(f.read())
+            reg_writer.writerow([obj.get(k) for k in registration_fields])
+            for person in obj['associated_people']:
+                people_writer.writerow(
+                    [obj['entity_id']] + [person.get(k) for k in person_fields[1:]]
+                )
 
-    # click.echo(fields)
 
     # for file in glob.glob('data/ut_registration*.json'):
     #     print(file)